@@ -0,0 +1,13 @@
+# ======================================================================
+# CONSTANTES DE AFIP COMPARTIDAS (FACTURACIÓN, PDF Y LIBRO IVA)
+# ======================================================================
+
+# Letra y título por tipo de comprobante AFIP
+TIPOS_CBTE = {
+    1: ("A", "FACTURA"), 2: ("A", "NOTA DE DÉBITO"), 3: ("A", "NOTA DE CRÉDITO"),
+    6: ("B", "FACTURA"), 7: ("B", "NOTA DE DÉBITO"), 8: ("B", "NOTA DE CRÉDITO"),
+    11: ("C", "FACTURA"), 12: ("C", "NOTA DE DÉBITO"), 13: ("C", "NOTA DE CRÉDITO")
+}
+
+# Alícuotas de IVA de AFIP (Id -> porcentaje)
+ALICUOTAS_IVA = {3: 0.0, 4: 10.5, 5: 21.0, 6: 27.0, 8: 5.0, 9: 2.5}
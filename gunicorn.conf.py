@@ -0,0 +1,7 @@
+# Configuración de gunicorn (se carga sola desde el directorio de trabajo)
+
+def post_fork(server, worker):
+    # Arrancar el health check de AFIP en cuanto nace cada worker,
+    # sin esperar a la primera solicitud
+    import main
+    main.iniciar_health()
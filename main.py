@@ -1,6 +1,13 @@
 import os
+import sys
+import time
+import uuid
+import threading
+import base64
 import datetime
-from flask import Flask, request, jsonify, send_from_directory
+from io import BytesIO
+import click
+from flask import Flask, request, jsonify, send_from_directory, g, Response, stream_with_context
 from zeep import Client
 from zeep.transports import Transport
 from requests import Session
@@ -8,7 +15,15 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.poolmanager import PoolManager
 import ssl
 from zeep.exceptions import Fault
+from werkzeug.exceptions import HTTPException
 from pdf_generator import crear_pdf_factura
+from tracing import span, iniciar_span, finalizar_span
+import profiling
+import rate_limit
+import pdf_storage
+import ventas
+from afip_constantes import ALICUOTAS_IVA, TIPOS_CBTE
+from rate_limit import LimiteExcedido
 
 app = Flask(__name__)
 
@@ -43,12 +58,44 @@ else:
 PDF_DIR = os.path.join(os.path.dirname(__file__), "pdfs")
 os.makedirs(PDF_DIR, exist_ok=True)
 
+# Cómo devolver el PDF en /facturar (campo "formato_pdf"):
+#   "url": se guarda en PDF_DIR y se devuelve el link a /descargar_pdf
+#   "base64": el PDF va embebido en el JSON
+#   "multipart": respuesta multipart/mixed con el JSON y el PDF
+FORMATOS_PDF = ("url", "base64", "multipart")
+# Guardar también en disco los PDFs devueltos inline (GUARDAR_PDF=0 para no escribir)
+GUARDAR_PDF = os.environ.get("GUARDAR_PDF", "1") == "1"
+
+# Los comprobantes autorizados no cambian: se pueden cachear por un año
+PDF_CACHE_MAX_AGE = 365 * 24 * 3600
+# Delegar el envío del archivo al proxy (nginx: prefijo de la location "internal")
+PDF_X_ACCEL_PREFIX = os.environ.get("PDF_X_ACCEL_PREFIX", "")
+# Delegar con X-Sendfile (Apache/lighttpd)
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "0") == "1"
+
 # Logo
 LOGO_PATH = os.path.join(os.path.dirname(__file__), "logo.jpeg")
 
 # Caché de tokens (para evitar límite de AFIP)
 TOKEN_CACHE = {}
 
+# Comprobante asociado por defecto para notas de débito/crédito (A, B y C)
+CBTE_ASOC_DEFAULT = {2: 1, 3: 1, 7: 6, 8: 6, 12: 11, 13: 11}
+
+# Caché de cotizaciones (FEParamGetCotizacion): se refresca una vez por día.
+# Un lock por moneda: una consulta lenta no frena a las demás monedas
+COTIZACION_CACHE = {}
+_cotizacion_locks = {}
+_cotizacion_locks_lock = threading.Lock()
+
+# Intervalo (segundos) entre chequeos de salud contra AFIP (FEDummy + WSAA). 0 = deshabilitado
+HEALTH_INTERVALO = int(os.environ.get("HEALTH_INTERVALO", "60"))
+# Tiempo máximo (segundos) de cada llamada del chequeo
+HEALTH_TIMEOUT = int(os.environ.get("HEALTH_TIMEOUT", "10"))
+
+# Token para endpoints de administración (/admin/*). Sin token, quedan deshabilitados
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
 # ======================================================================
 # ADAPTADOR SSL PARA DES (3DES)
 # ======================================================================
@@ -125,29 +172,36 @@ def sign_tra(tra, cert_file, key_file):
 def get_cached_token(cuit, cert_file, key_file):
     """Obtiene un token desde caché o genera uno nuevo si expiró"""
     
-    # Verificar si hay token en caché y no expiró
-    if cuit in TOKEN_CACHE:
-        cached = TOKEN_CACHE[cuit]
-        expiration = cached.get("expiration")
+    with span("token.cache", cuit=cuit) as s:
+        # Verificar si hay token en caché y no expiró
+        if cuit in TOKEN_CACHE:
+            cached = TOKEN_CACHE[cuit]
+            expiration = cached.get("expiration")
+            
+            # Si el token expira en más de 15 minutos, reutilizarlo
+            if expiration and expiration > datetime.datetime.utcnow() + datetime.timedelta(minutes=15):
+                print(f"✓ Reutilizando token en caché para {cuit} (expira: {expiration})")
+                if s:
+                    s.set("cache_hit", True)
+                return cached["token"], cached["sign"]
         
-        # Si el token expira en más de 15 minutos, reutilizarlo
-        if expiration and expiration > datetime.datetime.utcnow() + datetime.timedelta(minutes=15):
-            print(f"✓ Reutilizando token en caché para {cuit} (expira: {expiration})")
-            return cached["token"], cached["sign"]
-    
-    # Si no hay token válido, generar uno nuevo
-    print(f"Generando nuevo token para {cuit}...")
-    token, sign = get_token(cert_file, key_file)
-    
-    # Guardar en caché (tokens de AFIP duran 2 horas)
-    TOKEN_CACHE[cuit] = {
-        "token": token,
-        "sign": sign,
-        "expiration": datetime.datetime.utcnow() + datetime.timedelta(hours=2)
-    }
-    
-    print(f"✓ Token generado y almacenado en caché")
-    return token, sign
+        if s:
+            s.set("cache_hit", False)
+        
+        # Si no hay token válido, generar uno nuevo
+        print(f"Generando nuevo token para {cuit}...")
+        rate_limit.admitir(cuit, "loginCms")
+        token, sign = get_token(cert_file, key_file)
+        
+        # Guardar en caché (tokens de AFIP duran 2 horas)
+        TOKEN_CACHE[cuit] = {
+            "token": token,
+            "sign": sign,
+            "expiration": datetime.datetime.utcnow() + datetime.timedelta(hours=2)
+        }
+        
+        print(f"✓ Token generado y almacenado en caché")
+        return token, sign
 
 def get_token(cert_file, key_file):
     """Obtiene token y sign de AFIP"""
@@ -156,19 +210,22 @@ def get_token(cert_file, key_file):
         tra = create_tra()
         
         # 2) Firmar TRA
-        cms = sign_tra(tra, cert_file, key_file)
+        with span("wsaa.firmar_tra"):
+            cms = sign_tra(tra, cert_file, key_file)
         
         # 3) Cliente WSAA con SSL configurado
-        session = Session()
-        session.mount('https://', DESAdapter())
-        session.headers.update({
-            'Content-Type': 'text/xml; charset=utf-8'
-        })
-        transport = Transport(session=session)
-        client = Client(WSAA, transport=transport)
+        with span("wsaa.cliente"):
+            session = Session()
+            session.mount('https://', DESAdapter())
+            session.headers.update({
+                'Content-Type': 'text/xml; charset=utf-8'
+            })
+            transport = Transport(session=session)
+            client = Client(WSAA, transport=transport)
         
         # 4) Llamar a loginCms
-        response = client.service.loginCms(cms)
+        with span("wsaa.loginCms"):
+            response = client.service.loginCms(cms)
         
         # Debug: ver qué tipo de objeto es
         print(f"DEBUG Response type: {type(response)}")
@@ -221,6 +278,173 @@ def get_token(cert_file, key_file):
 # FACTURACIÓN
 # ----------------------------------------------------------------------
 
+def crear_cliente_wsfe(timeout=None):
+    """Cliente WSFE con headers y SSL configurado.
+
+    timeout: segundos máximos para cargar el WSDL y para cada operación (None = sin límite)
+    """
+    with span("wsfe.cliente"):
+        session = Session()
+        session.mount('https://', DESAdapter())
+        session.headers.update({
+            'Content-Type': 'text/xml; charset=utf-8'
+        })
+        if timeout is None:
+            transport = Transport(session=session)
+        else:
+            transport = Transport(session=session, timeout=timeout, operation_timeout=timeout)
+        return Client(WSFE, transport=transport)
+
+def consultar_comprobantes(cuit, punto_venta, tipo_cbte, desde_fecha):
+    """Recorre los comprobantes de AFIP del más nuevo al más viejo hasta `desde_fecha` (AAAAMMDD).
+
+    Genera dicts con las columnas de la tabla `comprobantes` de ventas.py.
+    """
+    cert_file, key_file = load_cert(cuit)
+    token, sign = get_cached_token(cuit, cert_file, key_file)
+    auth = {'Token': token, 'Sign': sign, 'Cuit': int(cuit)}
+    client = crear_cliente_wsfe()
+    
+    rate_limit.admitir(cuit, "FECompUltimoAutorizado")
+    ultimo = client.service.FECompUltimoAutorizado(Auth=auth, PtoVta=punto_venta, CbteTipo=tipo_cbte)
+    # Sin este chequeo un error de auth devuelve CbteNro 0 y se reconstruiría un período vacío
+    if ultimo.Errors:
+        raise Exception(f"AFIP error {ultimo.Errors.Err[0].Code}: {ultimo.Errors.Err[0].Msg}")
+    nro = ultimo.CbteNro
+    while nro > 0:
+        rate_limit.admitir(cuit, "FECompConsultar")
+        resp = client.service.FECompConsultar(
+            Auth=auth,
+            FeCompConsReq={'CbteTipo': tipo_cbte, 'CbteNro': nro, 'PtoVta': punto_venta}
+        )
+        if resp.Errors:
+            raise Exception(f"AFIP error {resp.Errors.Err[0].Code}: {resp.Errors.Err[0].Msg}")
+        cbte = resp.ResultGet
+        if int(cbte.CbteFch) < desde_fecha:
+            break
+        alicuotas = cbte.Iva.AlicIva if cbte.Iva else []
+        importes = {
+            "neto": float(cbte.ImpNeto or 0),
+            "no_gravado": float(cbte.ImpTotConc or 0),
+            "exento": float(cbte.ImpOpEx or 0),
+            "imp_iva": float(cbte.ImpIVA or 0),
+            "imp_trib": float(cbte.ImpTrib or 0),
+            "iva": [{"id": int(a.Id), "importe": float(a.Importe)} for a in alicuotas]
+        }
+        yield {
+            **ventas.columnas_importes(importes),
+            "cuit": str(cuit),
+            "tipo_cbte": tipo_cbte,
+            "punto_venta": punto_venta,
+            "cbte_nro": nro,
+            "fecha": int(cbte.CbteFch),
+            "doc_tipo": cbte.DocTipo,
+            "doc_nro": str(cbte.DocNro),
+            "condicion_iva_receptor": getattr(cbte, "CondicionIVAReceptorId", None),
+            "importe": float(cbte.ImpTotal),
+            "moneda": cbte.MonId or "PES",
+            "cotizacion": float(cbte.MonCotiz or 1),
+            "cae": str(cbte.CodAutorizacion),
+            "vencimiento_cae": str(cbte.FchVto)
+        }
+        nro -= 1
+
+def calcular_importes(data):
+    """Arma los importes del comprobante (neto, IVA por alícuota, tributos y total).
+
+    Sin arrays "iva"/"tributos" se comporta como antes: todo el importe es neto (Factura C).
+    """
+    iva = []
+    for item in data.get("iva") or []:
+        alic_id = int(item["id"])
+        if alic_id not in ALICUOTAS_IVA:
+            raise Exception(f"Alícuota de IVA inválida: {alic_id}")
+        base_imp = round(float(item["base_imp"]), 2)
+        if item.get("importe") is not None:
+            importe_iva = round(float(item["importe"]), 2)
+        else:
+            importe_iva = round(base_imp * ALICUOTAS_IVA[alic_id] / 100, 2)
+        iva.append({"id": alic_id, "base_imp": base_imp, "importe": importe_iva})
+    
+    tributos = []
+    for item in data.get("tributos") or []:
+        tributos.append({
+            "id": int(item["id"]),
+            "desc": str(item.get("desc", "")),
+            "base_imp": round(float(item["base_imp"]), 2),
+            "alic": round(float(item.get("alic", 0)), 2),
+            "importe": round(float(item["importe"]), 2)
+        })
+    
+    no_gravado = round(float(data.get("importe_no_gravado", 0)), 2)
+    exento = round(float(data.get("importe_exento", 0)), 2)
+    if data.get("importe_neto") is not None:
+        neto = round(float(data["importe_neto"]), 2)
+    elif iva:
+        neto = round(sum(i["base_imp"] for i in iva), 2)
+    else:
+        neto = round(float(data["importe"]) - no_gravado - exento, 2)
+    
+    imp_iva = round(sum((i["importe"] for i in iva), 0.0), 2)
+    imp_trib = round(sum((t["importe"] for t in tributos), 0.0), 2)
+    total = round(neto + no_gravado + exento + imp_iva + imp_trib, 2)
+    
+    if data.get("importe") is not None and abs(total - float(data["importe"])) > 0.01:
+        raise Exception(f"El importe ({data['importe']}) no coincide con la suma de neto, IVA y tributos ({total})")
+    
+    return {
+        "neto": neto,
+        "no_gravado": no_gravado,
+        "exento": exento,
+        "iva": iva,
+        "tributos": tributos,
+        "imp_iva": imp_iva,
+        "imp_trib": imp_trib,
+        "total": total
+    }
+
+def validar_letra(tipo_cbte, importes):
+    """Verifica que el desglose de IVA corresponda a la letra, antes de llamar a AFIP"""
+    if tipo_cbte not in TIPOS_CBTE:
+        raise Exception(f"Tipo de comprobante no soportado: {tipo_cbte} "
+                        f"(opciones: {', '.join(str(t) for t in TIPOS_CBTE)})")
+    letra = TIPOS_CBTE[tipo_cbte][0]
+    if letra in ("A", "B") and importes["neto"] > 0 and not importes["iva"]:
+        raise Exception(f"Los comprobantes {letra} requieren el detalle de IVA ('iva') para el neto gravado")
+    if letra == "C" and importes["iva"]:
+        raise Exception("Los comprobantes C no discriminan IVA: quitar 'iva' del request")
+
+def obtener_cotizacion(client, auth, moneda):
+    """Cotización de `moneda` desde AFIP, cacheada por día"""
+    hoy = datetime.date.today()
+    cached = COTIZACION_CACHE.get(moneda)
+    if cached and cached["fecha"] == hoy:
+        return cached["cotizacion"]
+    
+    with _cotizacion_locks_lock:
+        lock = _cotizacion_locks.setdefault(moneda, threading.Lock())
+    
+    with lock:
+        # Otro hilo pudo haberla actualizado mientras esperábamos
+        cached = COTIZACION_CACHE.get(moneda)
+        if cached and cached["fecha"] == hoy:
+            return cached["cotizacion"]
+        
+        print(f"Consultando cotización {moneda} en AFIP...")
+        rate_limit.admitir(auth['Cuit'], "FEParamGetCotizacion")
+        try:
+            with span("wsfe.FEParamGetCotizacion", moneda=moneda):
+                resp = client.service.FEParamGetCotizacion(Auth=auth, MonId=moneda)
+        except Fault as e:
+            raise Exception(f"Error cotización {moneda}: {e.message}")
+        if resp.Errors:
+            raise Exception(f"AFIP error {resp.Errors.Err[0].Code}: {resp.Errors.Err[0].Msg}")
+        
+        cotizacion = float(resp.ResultGet.MonCotiz)
+        COTIZACION_CACHE[moneda] = {"fecha": hoy, "cotizacion": cotizacion}
+        print(f"✓ Cotización {moneda}: {cotizacion}")
+        return cotizacion
+
 def crear_factura(data):
     # Limpiar CUITs/DNI de guiones y espacios
     cuit_emisor = str(data["cuit_emisor"]).replace("-", "").replace(" ", "").strip()
@@ -228,7 +452,15 @@ def crear_factura(data):
     tipo_doc_receptor = int(data.get("tipo_doc_receptor", 80))  # 80=CUIT, 96=DNI
     punto_venta = int(data["punto_venta"])
     tipo_cbte = int(data["tipo_cbte"])
-    importe = float(data["importe"])
+    concepto = int(data.get("concepto", 1))  # 1=Productos, 2=Servicios, 3=Productos y Servicios
+    moneda = str(data.get("moneda", "PES")).upper()
+    # Moneda extranjera: si el comprobante se cancela en esa misma moneda (S/N)
+    cancela_misma_moneda = str(data.get("cancela_misma_moneda", "N")).upper()
+    if cancela_misma_moneda not in ("S", "N"):
+        raise Exception(f"cancela_misma_moneda inválido: {cancela_misma_moneda} (S o N)")
+    importes = calcular_importes(data)
+    validar_letra(tipo_cbte, importes)
+    importe = importes["total"]
     
     # Log para debugging
     print(f"\n=== INICIANDO FACTURACIÓN ===")
@@ -237,7 +469,7 @@ def crear_factura(data):
     print(f"Doc Receptor: {doc_receptor} (Tipo: {tipo_doc_receptor})")
     print(f"Punto Venta: {punto_venta}")
     print(f"Tipo Comprobante: {tipo_cbte}")
-    print(f"Importe: {importe}")
+    print(f"Importe: {importe} {moneda}")
 
     cert_file, key_file = load_cert(cuit_emisor)
     print(f"Certificado: {cert_file}")
@@ -248,22 +480,20 @@ def crear_factura(data):
 
     # 2) Cliente WSFE con headers y SSL configurado
     print("2. Conectando a WSFE...")
-    session = Session()
-    session.mount('https://', DESAdapter())
-    session.headers.update({
-        'Content-Type': 'text/xml; charset=utf-8'
-    })
-    transport = Transport(session=session)
-    client = Client(WSFE, transport=transport)
+    client = crear_cliente_wsfe()
 
     # 3) Último comprobante
     print(f"3. Consultando último comprobante (PtoVta: {punto_venta}, Tipo: {tipo_cbte})...")
+    # Reservar turno para las dos llamadas antes de la primera: si el CAE está
+    # saturado, se responde 429 sin haber consultado a AFIP
+    rate_limit.admitir_todas(cuit_emisor, ("FECompUltimoAutorizado", "FECAESolicitar"))
     try:
-        ultimo = client.service.FECompUltimoAutorizado(
-            Auth={'Token': token, 'Sign': sign, 'Cuit': int(cuit_emisor)},
-            PtoVta=punto_venta,
-            CbteTipo=tipo_cbte
-        )
+        with span("wsfe.FECompUltimoAutorizado", pto_vta=punto_venta, cbte_tipo=tipo_cbte):
+            ultimo = client.service.FECompUltimoAutorizado(
+                Auth={'Token': token, 'Sign': sign, 'Cuit': int(cuit_emisor)},
+                PtoVta=punto_venta,
+                CbteTipo=tipo_cbte
+            )
         cbte_nro = ultimo.CbteNro + 1
         print(f"✓ Último comprobante: {ultimo.CbteNro}, Próximo: {cbte_nro}")
     except Fault as e:
@@ -286,6 +516,14 @@ def crear_factura(data):
     
     print(f"Condición IVA Receptor: {condicion_iva_receptor}")
     
+    # Cotización: PES = 1, explícita en el request o cacheada del día
+    if moneda == "PES":
+        cotizacion = 1.00
+    elif data.get("cotizacion"):
+        cotizacion = float(data["cotizacion"])
+    else:
+        cotizacion = obtener_cotizacion(client, {'Token': token, 'Sign': sign, 'Cuit': int(cuit_emisor)}, moneda)
+    
     FeCabReq = {
         'CantReg': 1,
         'PtoVta': punto_venta,
@@ -293,26 +531,53 @@ def crear_factura(data):
     }
     
     FeDetReq = {
-        'Concepto': 1,
+        'Concepto': concepto,
         'DocTipo': tipo_doc_receptor,  # 80=CUIT, 96=DNI
         'DocNro': int(doc_receptor),
         'CbteDesde': cbte_nro,
         'CbteHasta': cbte_nro,
         'CbteFch': fecha,
-        'ImpTotal': round(importe, 2),
-        'ImpTotConc': 0.00,
-        'ImpNeto': round(importe, 2),
-        'ImpOpEx': 0.00,
-        'ImpIVA': 0.00,
-        'ImpTrib': 0.00,
-        'MonId': 'PES',
-        'MonCotiz': 1.00,
+        'ImpTotal': importe,
+        'ImpTotConc': importes["no_gravado"],
+        'ImpNeto': importes["neto"],
+        'ImpOpEx': importes["exento"],
+        'ImpIVA': importes["imp_iva"],
+        'ImpTrib': importes["imp_trib"],
+        'MonId': moneda,
+        'MonCotiz': cotizacion,
         'CondicionIVAReceptorId': condicion_iva_receptor  # Campo obligatorio para AFIP
     }
     
-    # Si es Nota de Crédito (tipo 13), agregar comprobante asociado
-    if tipo_cbte == 13:
-        cbte_asoc_tipo = int(data.get("cbte_asoc_tipo", 11))  # Por defecto factura tipo C
+    # Moneda extranjera: obligatorio indicar si se cancela en la misma moneda
+    if moneda != "PES":
+        FeDetReq['CanMisMonExt'] = cancela_misma_moneda
+    
+    # Servicios: período facturado y vencimiento del pago (por defecto, hoy)
+    if concepto in (2, 3):
+        FeDetReq['FchServDesde'] = int(data.get("fecha_serv_desde") or fecha)
+        FeDetReq['FchServHasta'] = int(data.get("fecha_serv_hasta") or fecha)
+        FeDetReq['FchVtoPago'] = int(data.get("fecha_vto_pago") or fecha)
+    
+    # Alícuotas de IVA (solo A y B; las C no discriminan IVA)
+    if importes["iva"]:
+        FeDetReq['Iva'] = {
+            'AlicIva': [{'Id': i["id"], 'BaseImp': i["base_imp"], 'Importe': i["importe"]} for i in importes["iva"]]
+        }
+    
+    if importes["tributos"]:
+        FeDetReq['Tributos'] = {
+            'Tributo': [{
+                'Id': t["id"],
+                'Desc': t["desc"],
+                'BaseImp': t["base_imp"],
+                'Alic': t["alic"],
+                'Importe': t["importe"]
+            } for t in importes["tributos"]]
+        }
+    
+    # Si es Nota de Débito/Crédito, agregar comprobante asociado
+    if tipo_cbte in CBTE_ASOC_DEFAULT:
+        cbte_asoc_tipo = int(data.get("cbte_asoc_tipo", CBTE_ASOC_DEFAULT[tipo_cbte]))
         cbte_asoc_pto_vta = int(data.get("cbte_asoc_pto_vta", punto_venta))
         cbte_asoc_nro = int(data.get("cbte_asoc_nro"))
         
@@ -324,7 +589,7 @@ def crear_factura(data):
             }]
         }
         
-        print(f"Nota de Crédito - Factura asociada:")
+        print(f"Nota de Débito/Crédito - Factura asociada:")
         print(f"  - Tipo: {cbte_asoc_tipo}")
         print(f"  - Punto Venta: {cbte_asoc_pto_vta}")
         print(f"  - Número: {cbte_asoc_nro}")
@@ -338,16 +603,17 @@ def crear_factura(data):
     print(f"  - Fecha: {fecha}")
     print(f"  - Número: {cbte_nro}")
     print(f"  - Doc Receptor: {int(doc_receptor)}")
-    print(f"  - Importe Total: {round(importe, 2)}")
+    print(f"  - Importe Total: {importe} {moneda} (cotización {cotizacion})")
     print(f"  - Condición IVA: {condicion_iva_receptor}")
 
     # 5) Solicitar CAE
     print("5. Solicitando CAE a AFIP...")
     try:
-        resultado = client.service.FECAESolicitar(
-            Auth={'Token': token, 'Sign': sign, 'Cuit': int(cuit_emisor)},
-            FeCAEReq=FeCAEReq
-        )
+        with span("wsfe.FECAESolicitar", cbte_nro=cbte_nro):
+            resultado = client.service.FECAESolicitar(
+                Auth={'Token': token, 'Sign': sign, 'Cuit': int(cuit_emisor)},
+                FeCAEReq=FeCAEReq
+            )
         
         print(f"Respuesta AFIP recibida")
         
@@ -376,11 +642,36 @@ def crear_factura(data):
             print(f"✓ CAE obtenido: {cae}")
             print(f"✓ Vencimiento: {vencimiento}")
             
+            # Registrar comprobante y agregados mensuales (no fallar la factura si esto falla)
+            try:
+                ventas.registrar_comprobante({
+                    "cuit": cuit_emisor,
+                    "tipo_cbte": tipo_cbte,
+                    "punto_venta": punto_venta,
+                    "cbte_nro": cbte_nro,
+                    "fecha": fecha,
+                    "doc_tipo": tipo_doc_receptor,
+                    "doc_nro": doc_receptor,
+                    "receptor": data.get("compania", ""),
+                    "condicion_iva_receptor": condicion_iva_receptor,
+                    **ventas.columnas_importes(importes),
+                    "importe": importe,
+                    "moneda": moneda,
+                    "cotizacion": cotizacion,
+                    "cae": str(cae),
+                    "vencimiento_cae": str(vencimiento)
+                })
+            except Exception as e:
+                print(f"⚠ Error actualizando agregados de ventas: {str(e)}")
+            
             return {
                 "cbte_nro": cbte_nro,
                 "cae": cae,
                 "vencimiento": vencimiento,
-                "fecha": fecha
+                "fecha": fecha,
+                "moneda": moneda,
+                "cotizacion": cotizacion,
+                "importes": importes
             }
         else:
             # Rechazado
@@ -398,6 +689,160 @@ def crear_factura(data):
         print(f"✗ Error inesperado: {str(e)}")
         raise
 
+def escribir_pdf(pdf_path, pdf_bytes, intentos=2):
+    """Escribe el PDF creando su carpeta. Reintenta si la compactación la borró en el medio"""
+    for intento in range(intentos):
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        try:
+            with open(pdf_path, "wb") as f:
+                f.write(pdf_bytes)
+            return
+        except FileNotFoundError:
+            if intento == intentos - 1:
+                raise
+
+def respuesta_multipart(payload, pdf_bytes, pdf_filename):
+    """Arma una respuesta multipart/mixed con el JSON de la factura y el PDF"""
+    boundary = uuid.uuid4().hex
+    json_part = app.json.dumps(payload).encode("utf-8")
+    cuerpo = b"".join([
+        f"--{boundary}\r\n".encode(),
+        b"Content-Type: application/json; charset=utf-8\r\n\r\n",
+        json_part,
+        f"\r\n--{boundary}\r\n".encode(),
+        b"Content-Type: application/pdf\r\n",
+        f'Content-Disposition: attachment; filename="{pdf_filename}"\r\n\r\n'.encode(),
+        pdf_bytes,
+        f"\r\n--{boundary}--\r\n".encode()
+    ])
+    return Response(cuerpo, mimetype=f"multipart/mixed; boundary={boundary}")
+
+# ----------------------------------------------------------------------
+# HEALTH CHECK EN SEGUNDO PLANO
+# ----------------------------------------------------------------------
+
+# Último resultado; /health solo lee este dict (se reemplaza entero en cada chequeo)
+HEALTH_ESTADO = {"status": "INICIANDO" if HEALTH_INTERVALO > 0 else "DESHABILITADO", "chequeado": None}
+_health_lock = threading.Lock()
+_health_thread = None
+_health_pid = None
+
+def chequear_afip(client):
+    """Ejecuta FEDummy en WSFE y verifica que WSAA responda. Devuelve el estado"""
+    estado = {"wsfe": {}, "wsaa": {}}
+    
+    inicio = time.perf_counter()
+    try:
+        dummy = client.service.FEDummy()
+        estado["wsfe"] = {
+            "ok": all(getattr(dummy, k, None) == "OK" for k in ("AppServer", "DbServer", "AuthServer")),
+            "AppServer": dummy.AppServer,
+            "DbServer": dummy.DbServer,
+            "AuthServer": dummy.AuthServer
+        }
+    except Exception as e:
+        estado["wsfe"] = {"ok": False, "error": str(e)}
+    estado["wsfe"]["latencia_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+    
+    # WSAA: solo alcanzabilidad del WSDL (loginCms consumiría cupo de tokens)
+    inicio = time.perf_counter()
+    try:
+        with Session() as session:
+            session.mount('https://', DESAdapter())
+            resp = session.get(WSAA, timeout=HEALTH_TIMEOUT)
+        estado["wsaa"] = {"ok": resp.status_code == 200, "http_status": resp.status_code}
+    except Exception as e:
+        estado["wsaa"] = {"ok": False, "error": str(e)}
+    estado["wsaa"]["latencia_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+    
+    estado["status"] = "OK" if estado["wsfe"]["ok"] and estado["wsaa"]["ok"] else "DEGRADADO"
+    estado["chequeado"] = datetime.datetime.utcnow().isoformat()
+    return estado
+
+def _loop_health():
+    global HEALTH_ESTADO
+    client = None
+    while True:
+        try:
+            if client is None:
+                client = crear_cliente_wsfe(timeout=HEALTH_TIMEOUT)
+            HEALTH_ESTADO = chequear_afip(client)
+        except Exception as e:
+            client = None
+            HEALTH_ESTADO = {
+                "status": "DEGRADADO",
+                "chequeado": datetime.datetime.utcnow().isoformat(),
+                "error": str(e)
+            }
+        if HEALTH_ESTADO["status"] != "OK":
+            # Recrear el cliente por si el WSDL cambió o la conexión quedó rota
+            client = None
+            # A stderr: stdout puede ser la salida de un export en curso
+            print(f"⚠ Health check AFIP: {HEALTH_ESTADO}", file=sys.stderr)
+        time.sleep(HEALTH_INTERVALO)
+
+def iniciar_health():
+    """Arranca el hilo de chequeo, uno por proceso.
+
+    Se llama desde el post_fork de gunicorn (gunicorn.conf.py) y, como respaldo,
+    en cada solicitud; nunca al importar, para que la CLI no consulte a AFIP.
+    Los hilos no sobreviven al fork, por eso se compara el pid.
+    """
+    global _health_thread, _health_pid
+    if HEALTH_INTERVALO <= 0 or _health_pid == os.getpid():
+        return
+    with _health_lock:
+        if _health_pid != os.getpid():
+            _health_thread = threading.Thread(target=_loop_health, name="health-afip", daemon=True)
+            _health_thread.start()
+            _health_pid = os.getpid()
+
+def health_vencido(estado):
+    """True si el último chequeo es más viejo que 2 intervalos (hilo colgado o muerto)"""
+    if not estado.get("chequeado"):
+        return True
+    antiguedad = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(estado["chequeado"])
+    return antiguedad.total_seconds() > 2 * max(HEALTH_INTERVALO, HEALTH_TIMEOUT)
+
+def estado_tokens():
+    """Vigencia de los tokens en caché por CUIT"""
+    ahora = datetime.datetime.utcnow()
+    tokens = {}
+    for cuit, cached in list(TOKEN_CACHE.items()):
+        expiration = cached.get("expiration")
+        restante = (expiration - ahora).total_seconds() if expiration else 0
+        tokens[cuit] = {
+            "expira": expiration.isoformat() if expiration else None,
+            "minutos_restantes": round(max(restante, 0) / 60, 1),
+            # Igual criterio que get_cached_token: se renueva a menos de 15 minutos
+            "vigente": restante > 15 * 60
+        }
+    return tokens
+
+# ----------------------------------------------------------------------
+# TRAZAS Y PERFILADO POR SOLICITUD
+# ----------------------------------------------------------------------
+
+@app.before_request
+def _iniciar_health():
+    # Respaldo si el servidor no pasó por post_fork (ej. app.run o flask run)
+    iniciar_health()
+
+@app.before_request
+def _iniciar_traza():
+    g.span_request = iniciar_span(f"{request.method} {request.path}", endpoint=request.endpoint or "")
+    # Las llamadas de administración no consumen perfiles armados
+    if not request.path.startswith("/admin/"):
+        g.perfil = profiling.iniciar()
+
+@app.teardown_request
+def _finalizar_traza(exc):
+    profiling.finalizar(g.pop("perfil", None), f"{request.method} {request.path}")
+    finalizar_span(g.pop("span_request", None), exc)
+
+def _es_admin():
+    return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+
 # ----------------------------------------------------------------------
 # ENDPOINTS
 # ----------------------------------------------------------------------
@@ -409,7 +854,17 @@ def facturar():
         print(f"\n{'='*60}")
         print(f"NUEVA SOLICITUD DE FACTURACIÓN")
         print(f"{'='*60}")
-        factura = crear_factura(data)
+        
+        # Validar el formato antes de pedir el CAE
+        formato_pdf = data.get("formato_pdf", "url")
+        if formato_pdf not in FORMATOS_PDF:
+            return jsonify({
+                "status": "ERROR",
+                "detalle": f"formato_pdf inválido: {formato_pdf} (opciones: {', '.join(FORMATOS_PDF)})"
+            }), 400
+        
+        with span("afip.crear_factura"):
+            factura = crear_factura(data)
         
         # Generar PDF automáticamente
         print("Generando PDF...")
@@ -418,11 +873,13 @@ def facturar():
         print(f"  domicilio: {data.get('domicilio', '')}")
         print(f"  condicion_iva: {data.get('condicion_iva', '')}")
         print(f"  nombre_asegurado: {data.get('nombre_asegurado', '')}")
+        pdf_bytes = None
+        pdf_filename = None
         try:
             cuit_emisor = data.get("cuit_emisor")
             punto_venta = data.get("punto_venta", 2)
             cbte_nro = factura["cbte_nro"]
-            tipo_cbte = data.get("tipo_cbte", 11)
+            tipo_cbte = int(data.get("tipo_cbte", 11))
             
             # Nombre del asegurado para el archivo (sin espacios ni caracteres especiales)
             nombre_asegurado = data.get("nombre_asegurado", "")
@@ -435,14 +892,18 @@ def facturar():
                 nombre_limpio = ''.join(c if c.isalnum() else '' for c in nombre_limpio)
                 nombre_archivo = f"_{nombre_limpio[:30]}"  # Máximo 30 caracteres
             
-            # Código de comprobante: 011 para factura, 013 para NC
-            codigo_cbte = "011" if tipo_cbte == 11 else "013"
+            # Código de comprobante AFIP con 3 dígitos (001 Factura A, 011 Factura C, 013 NC C, ...)
+            codigo_cbte = f"{tipo_cbte:03d}"
             
             # Formato: CUIT_COD_PV_NUM_Nombre.pdf
             # Ejemplo factura: 27239676931_011_2_7_SusanaGiachino.pdf
             # Ejemplo NC: 27239676931_013_2_17_MariaEugeniaCarregal.pdf
             pdf_filename = f"{cuit_emisor}_{codigo_cbte}_{punto_venta}_{cbte_nro}{nombre_archivo}.pdf"
-            pdf_path = os.path.join(PDF_DIR, pdf_filename)
+            
+            # Layout particionado: pdfs/<cuit>/<aaaa>/<mm>/<archivo>
+            fecha_emision = datetime.datetime.now()
+            pdf_relpath = pdf_storage.ruta_relativa(cuit_emisor, fecha_emision, pdf_filename)
+            pdf_path = os.path.join(PDF_DIR, *pdf_relpath.split("/"))
             
             # Datos para el PDF
             datos_pdf = {
@@ -451,10 +912,19 @@ def facturar():
                 "punto_venta": punto_venta,
                 "tipo_cbte": tipo_cbte,
                 "cbte_nro": cbte_nro,
-                "fecha_emision": datetime.datetime.now(),
+                "fecha_emision": fecha_emision,
                 "cae": factura["cae"],
                 "vencimiento_cae": factura["vencimiento"],
-                "importe": data.get("importe"),
+                "importe": factura["importes"]["total"],
+                "importes": factura["importes"],
+                "moneda": factura["moneda"],
+                "cotizacion": factura["cotizacion"],
+                "cancela_misma_moneda": str(data.get("cancela_misma_moneda", "N")).upper(),
+                "concepto": int(data.get("concepto", 1)),
+                "fecha_serv_desde": data.get("fecha_serv_desde") or factura["fecha"],
+                "fecha_serv_hasta": data.get("fecha_serv_hasta") or factura["fecha"],
+                "fecha_vto_pago": data.get("fecha_vto_pago") or factura["fecha"],
+                "tipo_doc_receptor": int(data.get("tipo_doc_receptor", 80)),
                 "descripcion": data.get("descripcion", ""),
                 "compania": data.get("compania", ""),
                 "domicilio": data.get("domicilio", ""),
@@ -462,25 +932,46 @@ def facturar():
                 "nombre_asegurado": nombre_asegurado
             }
             
-            # Si es Nota de Crédito, agregar datos del comprobante asociado
-            if tipo_cbte == 13:
+            # Si es Nota de Débito/Crédito, agregar datos del comprobante asociado
+            if tipo_cbte in CBTE_ASOC_DEFAULT:
                 datos_pdf["cbte_asoc_nro"] = data.get("cbte_asoc_nro", "")
                 datos_pdf["cbte_asoc_pto_vta"] = data.get("cbte_asoc_pto_vta", punto_venta)
             
-            # Generar PDF
-            crear_pdf_factura(datos_pdf, LOGO_PATH, pdf_path)
+            # Generar PDF en memoria
+            buffer_pdf = BytesIO()
+            with span("pdf.crear", archivo=pdf_filename):
+                crear_pdf_factura(datos_pdf, LOGO_PATH, buffer_pdf)
+            pdf_bytes = buffer_pdf.getvalue()
+            
+            # Guardar en disco solo si hace falta servirlo por URL
+            if formato_pdf == "url" or GUARDAR_PDF:
+                with span("pdf.escribir", bytes=len(pdf_bytes)):
+                    escribir_pdf(pdf_path, pdf_bytes)
+                
+                # URL del PDF
+                pdf_url = f"https://afip-microserver-1.onrender.com/descargar_pdf/{pdf_relpath}"
+                factura["pdf_url"] = pdf_url
             
-            # URL del PDF
-            pdf_url = f"https://afip-microserver-1.onrender.com/descargar_pdf/{pdf_filename}"
-            factura["pdf_url"] = pdf_url
+            factura["pdf_filename"] = pdf_filename
+            if formato_pdf == "base64":
+                factura["pdf_base64"] = base64.b64encode(pdf_bytes).decode("ascii")
             
-            print(f"✓ PDF generado: {pdf_filename}")
+            print(f"✓ PDF generado: {pdf_filename} ({len(pdf_bytes)} bytes, formato: {formato_pdf})")
             
         except Exception as e:
             print(f"⚠ Error generando PDF (factura OK): {str(e)}")
             # No fallar la factura si el PDF falla
         
-        return jsonify({"status": "OK", "factura": factura})
+        with span("respuesta.serializar"):
+            if formato_pdf == "multipart" and pdf_bytes is not None:
+                return respuesta_multipart({"status": "OK", "factura": factura}, pdf_bytes, pdf_filename)
+            return jsonify({"status": "OK", "factura": factura})
+    except LimiteExcedido as e:
+        print(f"⚠ {str(e)}")
+        respuesta = jsonify({"status": "ERROR", "detalle": str(e), "retry_after": e.retry_after})
+        respuesta.status_code = 429
+        respuesta.headers["Retry-After"] = str(e.retry_after)
+        return respuesta
     except Exception as e:
         print(f"\n{'='*60}")
         print(f"ERROR EN FACTURACIÓN: {str(e)}")
@@ -491,11 +982,31 @@ def facturar():
 def home():
     return f"AFIP Microserver v5 - Modo: {MODO}"
 
-@app.route("/descargar_pdf/<filename>", methods=["GET"])
+@app.route("/descargar_pdf/<path:filename>", methods=["GET"])
 def descargar_pdf(filename):
-    """Endpoint para descargar PDFs generados"""
+    """Endpoint para descargar PDFs generados (ETag por contenido, 304 y Range)"""
     try:
-        return send_from_directory(PDF_DIR, filename, as_attachment=True)
+        relpath = pdf_storage.resolver(PDF_DIR, filename)
+        if relpath is None:
+            return jsonify({"status": "ERROR", "detalle": f"PDF no encontrado: {filename}"}), 404
+        etag = pdf_storage.etag(os.path.join(PDF_DIR, *relpath.split("/")))
+        
+        if PDF_X_ACCEL_PREFIX:
+            # El proxy sirve el archivo (y resuelve Range); acá solo validamos y respondemos 304
+            respuesta = Response(mimetype="application/pdf")
+            respuesta.headers["X-Accel-Redirect"] = PDF_X_ACCEL_PREFIX.rstrip("/") + "/" + relpath
+            respuesta.headers["Content-Disposition"] = f'attachment; filename="{os.path.basename(relpath)}"'
+            respuesta.set_etag(etag)
+            respuesta.make_conditional(request)
+        else:
+            respuesta = send_from_directory(PDF_DIR, relpath, as_attachment=True,
+                                            etag=etag, conditional=True, max_age=PDF_CACHE_MAX_AGE)
+        
+        respuesta.headers["Cache-Control"] = f"private, max-age={PDF_CACHE_MAX_AGE}, immutable"
+        return respuesta
+    except HTTPException:
+        # 416 (Range inválido) y similares
+        raise
     except Exception as e:
         return jsonify({"status": "ERROR", "detalle": f"PDF no encontrado: {str(e)}"}), 404
 
@@ -518,6 +1029,91 @@ def test():
         "tokens_en_cache": len(TOKEN_CACHE)
     })
 
+@app.route("/health", methods=["GET"])
+def health():
+    """Último estado de AFIP visto por este worker (no llama a AFIP). 503 si está degradado.
+
+    Con el chequeo deshabilitado (HEALTH_INTERVALO=0) responde 200 con los datos locales.
+    """
+    estado = dict(HEALTH_ESTADO)
+    if estado["status"] == "OK" and health_vencido(estado):
+        estado["status"] = "DEGRADADO"
+        estado["error"] = "Último chequeo vencido: el hilo de health no responde"
+    return jsonify({
+        **estado,
+        "modo": MODO,
+        "intervalo_segundos": HEALTH_INTERVALO,
+        "tokens": estado_tokens(),
+        "limites": rate_limit.metricas()
+    }), 200 if estado["status"] in ("OK", "DESHABILITADO") else 503
+
+@app.route("/metricas/limites", methods=["GET"])
+def metricas_limites():
+    """Estado de las colas del limitador de solicitudes a AFIP por CUIT y operación.
+
+    Los buckets son por proceso: con N workers la tasa real es N veces la configurada.
+    """
+    limites = {}
+    for op in rate_limit.LIMITES:
+        tasa, rafaga = rate_limit.limite(op)
+        limites[op] = {"tasa_por_segundo": tasa, "rafaga": rafaga}
+    return jsonify({
+        "status": "OK",
+        "alcance": "por proceso (con N workers, la tasa real es N veces la configurada)",
+        "pid": os.getpid(),
+        "config": {
+            "limites": limites,
+            "cola_max": rate_limit.COLA_MAX,
+            "espera_max": rate_limit.ESPERA_MAX
+        },
+        "buckets": rate_limit.metricas()
+    })
+
+@app.route("/resumen/<cuit>", methods=["GET"])
+def resumen(cuit):
+    """Totales facturados netos de NC en los últimos 12 meses (?hasta=AAAAMM, ?meses=N)"""
+    if not _es_admin():
+        return jsonify({"status": "ERROR", "detalle": "No autorizado"}), 403
+    try:
+        hasta = int(request.args.get("hasta") or datetime.datetime.now().strftime("%Y%m"))
+        meses = int(request.args.get("meses", 12))
+        if not (1 <= hasta % 100 <= 12) or hasta < 100001:
+            raise ValueError(f"hasta inválido: {hasta} (formato AAAAMM)")
+        if meses <= 0:
+            raise ValueError(f"meses debe ser mayor a 0: {meses}")
+        return jsonify({"status": "OK", "resumen": ventas.resumen(cuit, hasta, meses)})
+    except Exception as e:
+        return jsonify({"status": "ERROR", "detalle": str(e)}), 400
+
+@app.route("/exportar", methods=["GET"])
+def exportar():
+    """Exporta los comprobantes emitidos en streaming.
+
+    Parámetros: formato (csv|jsonl), cuit, desde/hasta (AAAAMMDD), tipo (ej. 11,13)
+    """
+    if not _es_admin():
+        return jsonify({"status": "ERROR", "detalle": "No autorizado"}), 403
+    formato = request.args.get("formato", "csv")
+    if formato not in ventas.EXPORTADORES:
+        return jsonify({
+            "status": "ERROR",
+            "detalle": f"formato inválido: {formato} (opciones: {', '.join(ventas.EXPORTADORES)})"
+        }), 400
+    try:
+        tipo = request.args.get("tipo")
+        comprobantes = ventas.iterar_comprobantes(
+            cuit=request.args.get("cuit"),
+            desde=int(request.args["desde"]) if request.args.get("desde") else None,
+            hasta=int(request.args["hasta"]) if request.args.get("hasta") else None,
+            tipos=[int(t) for t in tipo.split(",")] if tipo else None
+        )
+    except ValueError as e:
+        return jsonify({"status": "ERROR", "detalle": str(e)}), 400
+    exportador, mimetype = ventas.EXPORTADORES[formato]
+    respuesta = Response(stream_with_context(exportador(comprobantes)), mimetype=mimetype)
+    respuesta.headers["Content-Disposition"] = f'attachment; filename="comprobantes.{formato}"'
+    return respuesta
+
 @app.route("/limpiar_cache", methods=["POST"])
 def limpiar_cache():
     """Endpoint para limpiar el caché de tokens manualmente"""
@@ -528,5 +1124,65 @@ def limpiar_cache():
         "message": "Caché de tokens limpiado"
     })
 
+@app.route("/admin/perfilar", methods=["GET", "POST"])
+def admin_perfilar():
+    """Arma el perfilado de las próximas N solicitudes (POST) o devuelve los reportes (GET)"""
+    if not _es_admin():
+        return jsonify({"status": "ERROR", "detalle": "No autorizado"}), 403
+    if request.method == "POST":
+        data = request.json or {}
+        try:
+            profiling.armar(data.get("solicitudes", 1), data.get("modo", "cprofile"))
+        except ValueError as e:
+            return jsonify({"status": "ERROR", "detalle": str(e)}), 400
+        return jsonify({"status": "OK", "perfilado": profiling.estado()})
+    return jsonify({
+        "status": "OK",
+        "perfilado": profiling.estado(),
+        "reportes": profiling.reportes()
+    })
+
+@app.cli.command("compactar-pdfs")
+@click.option("--dias", type=int, default=None, help="Eliminar PDFs con más de N días")
+def compactar_pdfs(dias):
+    """Migra PDFs al layout cuit/año/mes y aplica la retención"""
+    resumen = pdf_storage.compactar(PDF_DIR, dias)
+    print(f"✓ Compactación terminada: {resumen}")
+
+@app.cli.command("reconstruir-resumen")
+@click.argument("cuit")
+@click.option("--punto-venta", type=int, multiple=True, default=[2],
+              help="Punto de venta a consultar (se puede repetir)")
+@click.option("--tipos", default="11,12,13", help="Tipos de comprobante separados por coma")
+@click.option("--meses", type=int, default=12, help="Meses hacia atrás a recalcular")
+def reconstruir_resumen(cuit, punto_venta, tipos, meses):
+    """Recalcula los agregados mensuales de un CUIT consultando AFIP (FECompConsultar).
+
+    También completa la tabla de comprobantes con los que falten (para /exportar).
+    """
+    hasta = int(datetime.datetime.now().strftime("%Y%m"))
+    desde = ventas.sumar_periodos(hasta, -(meses - 1))
+    comprobantes = []
+    for pto_vta in punto_venta:
+        for tipo_cbte in (int(t) for t in tipos.split(",")):
+            print(f"Consultando comprobantes tipo {tipo_cbte} (PtoVta: {pto_vta})...")
+            comprobantes.extend(consultar_comprobantes(cuit, pto_vta, tipo_cbte, desde * 100 + 1))
+    ventas.reemplazar_periodos(cuit, desde, hasta, comprobantes)
+    print(f"✓ Agregados y comprobantes de {cuit} recalculados ({desde}-{hasta}, {len(comprobantes)} comprobantes)")
+
+@app.cli.command("exportar-ventas")
+@click.option("--formato", type=click.Choice(list(ventas.EXPORTADORES)), default="csv")
+@click.option("--cuit", default=None)
+@click.option("--desde", type=int, default=None, help="Fecha inicial AAAAMMDD")
+@click.option("--hasta", type=int, default=None, help="Fecha final AAAAMMDD")
+@click.option("--tipo", default=None, help="Tipos de comprobante separados por coma")
+@click.option("--salida", type=click.File("w", encoding="utf-8"), default="-")
+def exportar_ventas(formato, cuit, desde, hasta, tipo, salida):
+    """Exporta los comprobantes emitidos (libro IVA ventas) a CSV o JSON Lines"""
+    tipos = [int(t) for t in tipo.split(",")] if tipo else None
+    exportador, _ = ventas.EXPORTADORES[formato]
+    for linea in exportador(ventas.iterar_comprobantes(cuit, desde, hasta, tipos)):
+        salida.write(linea)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -7,6 +7,8 @@ from reportlab.lib.units import mm
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
 import os
+from tracing import span
+from afip_constantes import ALICUOTAS_IVA, TIPOS_CBTE
 
 # Datos de los emisores
 EMISOR_DATA = {
@@ -26,13 +28,26 @@ EMISOR_DATA = {
     }
 }
 
+def _etiqueta_alicuota(alic_id):
+    """Id de alícuota -> etiqueta, ej. 4 -> 10,5%"""
+    if alic_id not in ALICUOTAS_IVA:
+        return ""
+    return f"{ALICUOTAS_IVA[alic_id]:g}".replace(".", ",") + "%"
+
+def _fecha_ddmmaaaa(fecha):
+    """AAAAMMDD -> DD/MM/AAAA"""
+    fecha = str(fecha)
+    if len(fecha) == 8:
+        return f"{fecha[6:8]}/{fecha[4:6]}/{fecha[0:4]}"
+    return fecha
+
 def crear_pdf_factura(datos, logo_path, output_path):
     """
     Genera un PDF de factura o nota de crédito.
     
     datos: diccionario con los datos del comprobante
     logo_path: ruta al logo
-    output_path: donde guardar el PDF
+    output_path: donde guardar el PDF (ruta o buffer en memoria, ej. BytesIO)
     """
     
     # Extraer datos
@@ -50,20 +65,26 @@ def crear_pdf_factura(datos, logo_path, output_path):
     domicilio = datos.get("domicilio", "")
     condicion_iva = datos.get("condicion_iva", "")
     nombre_asegurado = datos.get("nombre_asegurado", "")
-    
-    # Determinar si es NC
-    es_nota_credito = (tipo_cbte == 13)
+    moneda = datos.get("moneda", "PES")
+    cotizacion = float(datos.get("cotizacion", 1))
+    cancela_misma_moneda = datos.get("cancela_misma_moneda", "N")
+    concepto = int(datos.get("concepto", 1))
+    tipo_doc_receptor = datos.get("tipo_doc_receptor")
+    # Desglose de importes (ver calcular_importes en main.py); sin desglose, todo es neto
+    importes = datos.get("importes") or {"neto": importe, "iva": [], "imp_trib": 0.0, "total": importe}
+    
+    # Letra y título del comprobante
+    letra, titulo_cbte = TIPOS_CBTE.get(tipo_cbte, ("C", "FACTURA"))
+    es_nota_credito = (titulo_cbte == "NOTA DE CRÉDITO")
+    es_asociado = titulo_cbte != "FACTURA"
+    simbolo = "$" if moneda == "PES" else moneda
     
     # Formatear fecha de emisión
     if hasattr(fecha_emision, 'strftime'):
         fecha_emision = fecha_emision.strftime("%d/%m/%Y")
     
     # Formatear vencimiento CAE
-    if vencimiento_cae_raw and len(str(vencimiento_cae_raw)) == 8:
-        venc_str = str(vencimiento_cae_raw)
-        vencimiento_cae = f"{venc_str[6:8]}/{venc_str[4:6]}/{venc_str[0:4]}"
-    else:
-        vencimiento_cae = str(vencimiento_cae_raw)
+    vencimiento_cae = _fecha_ddmmaaaa(vencimiento_cae_raw) if vencimiento_cae_raw else ""
     
     # Obtener datos del emisor
     emisor_info = EMISOR_DATA.get(cuit_emisor, {})
@@ -84,12 +105,13 @@ def crear_pdf_factura(datos, logo_path, output_path):
     
     # Logo (arriba izquierda)
     if os.path.exists(logo_path):
-        try:
-            c.drawImage(logo_path, margin, height - 40*mm, width=30*mm, height=30*mm, preserveAspectRatio=True, mask='auto')
-        except:
-            pass
+        with span("pdf.logo"):
+            try:
+                c.drawImage(logo_path, margin, height - 40*mm, width=30*mm, height=30*mm, preserveAspectRatio=True, mask='auto')
+            except:
+                pass
     
-    # Letra "C" en el centro (bajada 4mm)
+    # Letra (A/B/C) en el centro (bajada 4mm)
     c.setFont("Helvetica-Bold", 40)
     letra_x = width / 2 - 10*mm
     letra_y = height - 32*mm
@@ -101,22 +123,21 @@ def crear_pdf_factura(datos, logo_path, output_path):
     c.line(linea_vertical_x, height - 8*mm, linea_vertical_x, letra_y + 20*mm + 2*mm)
     c.line(linea_vertical_x, letra_y - 2*mm, linea_vertical_x, height - 79*mm)
     
-    # Cuadro para la letra C
+    # Cuadro para la letra
     c.setStrokeColor(colors.black)
     c.setLineWidth(1.5)
     c.rect(letra_x, letra_y, 20*mm, 20*mm)
     
-    # Letra C
-    c.drawCentredString(letra_x + 10*mm, letra_y + 5*mm, "C")
+    # Letra
+    c.drawCentredString(letra_x + 10*mm, letra_y + 5*mm, letra)
     
-    # COD. 011 o 013
-    codigo_cbte = "011" if not es_nota_credito else "013"
+    # COD. 001, 006, 011, 013, ...
+    codigo_cbte = f"{tipo_cbte:03d}"
     c.setFont("Helvetica", 8)
     c.drawCentredString(letra_x + 10*mm, letra_y + 2*mm, f"COD. {codigo_cbte}")
     
-    # FACTURA o NOTA DE CRÉDITO arriba
-    titulo_cbte = "FACTURA" if not es_nota_credito else "NOTA DE CRÉDITO"
-    c.setFont("Helvetica", 12 if not es_nota_credito else 10)
+    # FACTURA, NOTA DE DÉBITO o NOTA DE CRÉDITO arriba
+    c.setFont("Helvetica", 12 if not es_asociado else 10)
     c.drawCentredString(letra_x + 10*mm, letra_y + 22*mm, titulo_cbte)
     
     # ================================================================
@@ -173,13 +194,14 @@ def crear_pdf_factura(datos, logo_path, output_path):
     
     receptor_y = separador_y_pos - 10*mm
     
-    # Si es NC, mostrar "ANULA FACTURA" en rojo
-    if es_nota_credito:
+    # Si es NC/ND, mostrar la factura asociada en rojo
+    if es_asociado:
         cbte_asoc_nro = datos.get("cbte_asoc_nro", "")
         cbte_asoc_pto_vta = datos.get("cbte_asoc_pto_vta", punto_venta)
         c.setFont("Helvetica-Bold", 9)
         c.setFillColor(colors.red)
-        c.drawString(margin, receptor_y, f"ANULA FACTURA Nº {str(cbte_asoc_pto_vta).zfill(4)}-{str(cbte_asoc_nro).zfill(8)}")
+        leyenda = "ANULA FACTURA" if es_nota_credito else "AJUSTA FACTURA"
+        c.drawString(margin, receptor_y, f"{leyenda} Nº {str(cbte_asoc_pto_vta).zfill(4)}-{str(cbte_asoc_nro).zfill(8)}")
         receptor_y -= 7*mm
         c.setFillColor(colors.black)
     
@@ -217,24 +239,59 @@ def crear_pdf_factura(datos, logo_path, output_path):
     c.setFont("Helvetica", 9)
     c.drawString(margin, detalle_y, descripcion)
     
+    # Servicios: período facturado y vencimiento del pago
+    if concepto in (2, 3):
+        detalle_y -= 6*mm
+        c.drawString(margin, detalle_y,
+                     f"Período Facturado Desde: {_fecha_ddmmaaaa(datos.get('fecha_serv_desde', ''))}  "
+                     f"Hasta: {_fecha_ddmmaaaa(datos.get('fecha_serv_hasta', ''))}  "
+                     f"Fecha de Vto. para el pago: {_fecha_ddmmaaaa(datos.get('fecha_vto_pago', ''))}")
+    
+    # Moneda extranjera: cotización usada
+    if moneda != "PES":
+        detalle_y -= 6*mm
+        c.drawString(margin, detalle_y, f"Moneda: {moneda}  -  Tipo de cambio: {cotizacion:,.4f}  -  "
+                                        f"Cancela en misma moneda: {'Sí' if cancela_misma_moneda == 'S' else 'No'}")
+    
     # ================================================================
     # TOTALES
     # ================================================================
     
-    totales_y = 100*mm
+    no_gravado = importes.get("no_gravado", 0.0)
+    exento = importes.get("exento", 0.0)
+    lineas_extra = len(importes["iva"]) + (1 if no_gravado else 0) + (1 if exento else 0)
+    totales_y = 100*mm + 5*mm * lineas_extra
     totales_x = width - margin - 50*mm
     
     c.setFont("Helvetica-Bold", 10)
-    c.drawRightString(totales_x, totales_y, "Subtotal: $")
-    c.drawRightString(width - margin, totales_y, f"{importe:,.2f}")
+    if letra == "A":
+        # Factura A: neto gravado e IVA discriminado por alícuota
+        c.drawRightString(totales_x, totales_y, f"Importe Neto Gravado: {simbolo}")
+        c.drawRightString(width - margin, totales_y, f"{importes['neto']:,.2f}")
+        for alic in importes["iva"]:
+            totales_y -= 5*mm
+            c.drawRightString(totales_x, totales_y, f"IVA {_etiqueta_alicuota(alic['id'])}: {simbolo}")
+            c.drawRightString(width - margin, totales_y, f"{alic['importe']:,.2f}")
+        if no_gravado:
+            totales_y -= 5*mm
+            c.drawRightString(totales_x, totales_y, f"Importe No Gravado: {simbolo}")
+            c.drawRightString(width - margin, totales_y, f"{no_gravado:,.2f}")
+        if exento:
+            totales_y -= 5*mm
+            c.drawRightString(totales_x, totales_y, f"Importe Exento: {simbolo}")
+            c.drawRightString(width - margin, totales_y, f"{exento:,.2f}")
+    else:
+        subtotal = importes["total"] - importes["imp_trib"]
+        c.drawRightString(totales_x, totales_y, f"Subtotal: {simbolo}")
+        c.drawRightString(width - margin, totales_y, f"{subtotal:,.2f}")
     
     totales_y -= 5*mm
-    c.drawRightString(totales_x, totales_y, "Importe Otros Tributos: $")
-    c.drawRightString(width - margin, totales_y, "0,00")
+    c.drawRightString(totales_x, totales_y, f"Importe Otros Tributos: {simbolo}")
+    c.drawRightString(width - margin, totales_y, f"{importes['imp_trib']:,.2f}")
     
     totales_y -= 5*mm
     c.setFont("Helvetica-Bold", 12)
-    c.drawRightString(totales_x, totales_y, "Importe Total: $")
+    c.drawRightString(totales_x, totales_y, f"Importe Total: {simbolo}")
     c.drawRightString(width - margin, totales_y, f"{importe:,.2f}")
     
     # ================================================================
@@ -249,9 +306,9 @@ def crear_pdf_factura(datos, logo_path, output_path):
         "tipoCmp": tipo_cbte,
         "nroCmp": int(cbte_nro),
         "importe": importe,
-        "moneda": "PES",
-        "ctz": 1,
-        "tipoDocRec": 96 if len(cuit_receptor) <= 8 else 80,
+        "moneda": moneda,
+        "ctz": cotizacion,
+        "tipoDocRec": int(tipo_doc_receptor) if tipo_doc_receptor else (96 if len(cuit_receptor) <= 8 else 80),
         "nroDocRec": int(cuit_receptor) if cuit_receptor else 0,
         "tipoCodAut": "E",
         "codAut": int(cae) if cae else 0
@@ -261,16 +318,17 @@ def crear_pdf_factura(datos, logo_path, output_path):
     qr_url = f"https://www.afip.gob.ar/fe/qr/?p={qr_json}"
     
     # Generar código QR
-    qr = qrcode.QRCode(version=1, box_size=3, border=1)
-    qr.add_data(qr_url)
-    qr.make(fit=True)
-    
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convertir a BytesIO
-    buffer = BytesIO()
-    qr_img.save(buffer, format='PNG')
-    buffer.seek(0)
+    with span("pdf.qr"):
+        qr = qrcode.QRCode(version=1, box_size=3, border=1)
+        qr.add_data(qr_url)
+        qr.make(fit=True)
+        
+        qr_img = qr.make_image(fill_color="black", back_color="white")
+        
+        # Convertir a BytesIO
+        buffer = BytesIO()
+        qr_img.save(buffer, format='PNG')
+        buffer.seek(0)
     
     # Dibujar QR en el PDF
     qr_x = margin
@@ -305,6 +363,8 @@ def crear_pdf_factura(datos, logo_path, output_path):
     c.drawString(info_x, info_y, "datos contenidos en la presente factura.")
     
     # Guardar PDF
-    c.save()
+    with span("pdf.guardar"):
+        c.save()
     
-    print(f"PDF generado exitosamente: {output_path}")
+    if isinstance(output_path, str):
+        print(f"PDF generado exitosamente: {output_path}")
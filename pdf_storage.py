@@ -0,0 +1,105 @@
+import os
+import re
+import time
+import hashlib
+from functools import lru_cache
+
+# ======================================================================
+# ALMACENAMIENTO DE PDFs (LAYOUT PARTICIONADO cuit/año/mes)
+# ======================================================================
+
+# Nombre de archivo: CUIT_COD_PV_NUM[_Nombre].pdf (ver facturar() en main.py)
+PATRON_NOMBRE = re.compile(r"^(\d{11})_\d{3}_\d+_\d+.*\.pdf$")
+
+
+def ruta_relativa(cuit, fecha, filename):
+    """Ruta relativa a PDF_DIR: <cuit>/<aaaa>/<mm>/<archivo>"""
+    return "/".join([str(cuit), fecha.strftime("%Y"), fecha.strftime("%m"), filename])
+
+
+def resolver(pdf_dir, ruta):
+    """Devuelve la ruta relativa existente para `ruta`, o None.
+
+    Acepta rutas particionadas (cuit/aaaa/mm/archivo.pdf) y nombres planos del
+    layout anterior; estos se buscan en la raíz y luego en las carpetas del CUIT.
+    """
+    partes = ruta.split("/")
+    if any(p in ("", ".", "..") for p in partes):
+        return None
+    if os.path.isfile(os.path.join(pdf_dir, *partes)):
+        return ruta
+    if len(partes) != 1:
+        return None
+    m = PATRON_NOMBRE.match(ruta)
+    if not m:
+        return None
+    carpeta_cuit = os.path.join(pdf_dir, m.group(1))
+    if not os.path.isdir(carpeta_cuit):
+        return None
+    # Recorrer meses del más reciente al más antiguo: O(meses), no O(archivos)
+    for anio in sorted(os.listdir(carpeta_cuit), reverse=True):
+        carpeta_anio = os.path.join(carpeta_cuit, anio)
+        if not os.path.isdir(carpeta_anio):
+            continue
+        for mes in sorted(os.listdir(carpeta_anio), reverse=True):
+            if os.path.isfile(os.path.join(carpeta_anio, mes, ruta)):
+                return "/".join([m.group(1), anio, mes, ruta])
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _hash_contenido(path, mtime_ns, size):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(64 * 1024), b""):
+            h.update(bloque)
+    return h.hexdigest()[:32]
+
+
+def etag(path):
+    """ETag por contenido (cacheado por ruta, mtime y tamaño)"""
+    st = os.stat(path)
+    return _hash_contenido(path, st.st_mtime_ns, st.st_size)
+
+
+def compactar(pdf_dir, dias_retencion=None):
+    """Migra PDFs del layout plano al particionado, aplica retención y borra carpetas vacías.
+
+    dias_retencion: si se indica, elimina PDFs con más de esa antigüedad.
+    Devuelve un resumen con las cantidades procesadas.
+    """
+    resumen = {"migrados": 0, "eliminados": 0, "carpetas_eliminadas": 0}
+    limite = time.time() - dias_retencion * 86400 if dias_retencion else None
+
+    # 1) Layout plano -> cuit/año/mes (según fecha de modificación)
+    with os.scandir(pdf_dir) as entradas:
+        for entrada in entradas:
+            if not entrada.is_file():
+                continue
+            m = PATRON_NOMBRE.match(entrada.name)
+            if not m:
+                continue
+            fecha = time.localtime(entrada.stat().st_mtime)
+            destino = os.path.join(pdf_dir, m.group(1), time.strftime("%Y", fecha), time.strftime("%m", fecha))
+            os.makedirs(destino, exist_ok=True)
+            os.replace(entrada.path, os.path.join(destino, entrada.name))
+            resumen["migrados"] += 1
+
+    # 2) Retención y limpieza de carpetas vacías (de abajo hacia arriba).
+    # No se borran las carpetas de CUIT ni las del mes en curso: facturar() puede
+    # haberlas creado y todavía no haber escrito el PDF
+    mes_actual = [time.strftime("%Y"), time.strftime("%m")]
+    for raiz, carpetas, archivos in os.walk(pdf_dir, topdown=False):
+        if limite is not None:
+            for nombre in archivos:
+                path = os.path.join(raiz, nombre)
+                if nombre.endswith(".pdf") and os.path.getmtime(path) < limite:
+                    os.remove(path)
+                    resumen["eliminados"] += 1
+        partes = os.path.relpath(raiz, pdf_dir).split(os.sep)
+        en_uso = len(partes) == 1 or partes[1:3] == mes_actual[:len(partes) - 1]
+        if raiz != pdf_dir and not en_uso and not os.listdir(raiz):
+            os.rmdir(raiz)
+            resumen["carpetas_eliminadas"] += 1
+
+    return resumen
@@ -0,0 +1,126 @@
+import io
+import sys
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+from collections import Counter, deque
+
+# ======================================================================
+# PERFILADO BAJO DEMANDA
+# ======================================================================
+
+# Se arma desde /admin/perfilar para las próximas N solicitudes.
+# Modos: "cprofile" (determinístico) o "muestreo" (sampling, menor overhead)
+MODOS = ("cprofile", "muestreo")
+INTERVALO_MUESTREO = 0.005  # segundos entre muestras
+MAX_REPORTES = 20
+TOP_FUNCIONES = 40
+
+_lock = threading.Lock()
+# Solo un perfil a la vez: cProfile no admite perfiles concurrentes
+_activo = threading.Lock()
+ESTADO = {"restantes": 0, "modo": "cprofile"}
+REPORTES = deque(maxlen=MAX_REPORTES)
+
+
+def armar(cantidad, modo="cprofile"):
+    """Perfila las próximas `cantidad` solicitudes con el modo indicado"""
+    if modo not in MODOS:
+        raise ValueError(f"Modo de perfilado inválido: {modo} (opciones: {', '.join(MODOS)})")
+    with _lock:
+        ESTADO["restantes"] = max(0, int(cantidad))
+        ESTADO["modo"] = modo
+
+
+def estado():
+    with _lock:
+        return {"restantes": ESTADO["restantes"], "modo": ESTADO["modo"], "reportes": len(REPORTES)}
+
+
+def reportes():
+    with _lock:
+        return list(REPORTES)
+
+
+class _Muestreador:
+    """Profiler por muestreo: toma el stack del hilo objetivo a intervalos fijos"""
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.muestras = Counter()
+        self.total = 0
+        self._stop = threading.Event()
+        self._hilo = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(INTERVALO_MUESTREO):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                pila.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.muestras[";".join(reversed(pila))] += 1
+            self.total += 1
+
+    def start(self):
+        self._hilo.start()
+
+    def stop(self):
+        self._stop.set()
+        self._hilo.join()
+
+    def reporte(self):
+        # Formato "collapsed stacks" (compatible con flamegraph.pl / speedscope)
+        lineas = [f"{pila} {n}" for pila, n in self.muestras.most_common()]
+        return f"# muestras: {self.total} (intervalo {INTERVALO_MUESTREO*1000:.0f} ms)\n" + "\n".join(lineas)
+
+
+def iniciar():
+    """Si hay perfilado armado, arranca un perfil para la solicitud actual"""
+    with _lock:
+        if ESTADO["restantes"] <= 0:
+            return None
+        if not _activo.acquire(blocking=False):
+            return None
+        ESTADO["restantes"] -= 1
+        modo = ESTADO["modo"]
+
+    if modo == "cprofile":
+        perfil = cProfile.Profile()
+        perfil.enable()
+    else:
+        perfil = _Muestreador(threading.get_ident())
+        perfil.start()
+    return {"modo": modo, "perfil": perfil, "inicio": time.perf_counter()}
+
+
+def finalizar(sesion, etiqueta=""):
+    """Detiene el perfil de la solicitud y guarda el reporte"""
+    if sesion is None:
+        return
+    try:
+        perfil = sesion["perfil"]
+        if sesion["modo"] == "cprofile":
+            perfil.disable()
+            salida = io.StringIO()
+            stats = pstats.Stats(perfil, stream=salida)
+            stats.sort_stats("cumulative").print_stats(TOP_FUNCIONES)
+            texto = salida.getvalue()
+        else:
+            perfil.stop()
+            texto = perfil.reporte()
+        with _lock:
+            REPORTES.append({
+                "solicitud": etiqueta,
+                "modo": sesion["modo"],
+                "fecha": datetime.datetime.utcnow().isoformat(),
+                "duracion_ms": round((time.perf_counter() - sesion["inicio"]) * 1000, 2),
+                "reporte": texto
+            })
+    finally:
+        _activo.release()
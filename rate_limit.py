@@ -0,0 +1,203 @@
+import os
+import math
+import time
+import threading
+
+# ======================================================================
+# CONTROL DE ADMISIÓN HACIA AFIP (TOKEN BUCKET POR CUIT Y OPERACIÓN)
+# ======================================================================
+
+# Los buckets viven en memoria de cada proceso: con N workers de gunicorn
+# la tasa real hacia AFIP es N veces la configurada.
+#
+# Configuración por entorno (de más específica a más general):
+#   AFIP_RATE_<OPERACION>_<CUIT> / AFIP_BURST_<OPERACION>_<CUIT>
+#   AFIP_RATE_<OPERACION> / AFIP_BURST_<OPERACION>
+#   LIMITES (abajo), y si la operación no figura, AFIP_RATE / AFIP_BURST
+# <OPERACION> va en mayúsculas, ej. AFIP_RATE_FECAESOLICITAR_27239676931=2
+
+# Valores por defecto: solicitudes por segundo y ráfaga máxima
+RATE_DEFAULT = float(os.environ.get("AFIP_RATE", "5"))
+BURST_DEFAULT = int(os.environ.get("AFIP_BURST", "10"))
+# Máximo de solicitudes esperando turno por bucket y espera máxima aceptada (segundos)
+COLA_MAX = int(os.environ.get("AFIP_COLA_MAX", "20"))
+ESPERA_MAX = float(os.environ.get("AFIP_ESPERA_MAX", "10"))
+
+# Límites por operación (tasa por segundo, ráfaga). WSAA limita fuerte los pedidos de token
+LIMITES = {
+    "loginCms": (1 / 60, 2),
+    "FECompUltimoAutorizado": (RATE_DEFAULT, BURST_DEFAULT),
+    "FECAESolicitar": (RATE_DEFAULT, BURST_DEFAULT),
+    "FECompConsultar": (RATE_DEFAULT, BURST_DEFAULT),
+    "FEParamGetCotizacion": (1, 2),
+}
+
+
+def _env(prefijo, operacion, cuit=None):
+    clave = f"{prefijo}_{operacion.upper()}"
+    if cuit is not None:
+        valor = os.environ.get(f"{clave}_{cuit}")
+        if valor is not None:
+            return valor
+    return os.environ.get(clave)
+
+
+def limite(operacion, cuit=None):
+    """(tasa por segundo, ráfaga) para `operacion` y `cuit` según el entorno y LIMITES"""
+    tasa, rafaga = LIMITES.get(operacion, (RATE_DEFAULT, BURST_DEFAULT))
+    tasa_env = _env("AFIP_RATE", operacion, cuit)
+    rafaga_env = _env("AFIP_BURST", operacion, cuit)
+    return (float(tasa_env) if tasa_env is not None else tasa,
+            int(rafaga_env) if rafaga_env is not None else rafaga)
+
+
+class LimiteExcedido(Exception):
+    """El bucket está saturado; reintentar después de `retry_after` segundos"""
+
+    def __init__(self, cuit, operacion, retry_after):
+        self.cuit = cuit
+        self.operacion = operacion
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        super().__init__(f"Límite de solicitudes a AFIP excedido ({operacion}, CUIT {cuit}). "
+                         f"Reintentar en {self.retry_after}s")
+
+
+class TokenBucket:
+    """Token bucket con cola de espera acotada (reserva el turno y duerme fuera del lock)"""
+
+    def __init__(self, tasa, capacidad, cola_max=COLA_MAX, espera_max=ESPERA_MAX):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.cola_max = cola_max
+        self.espera_max = espera_max
+        self.tokens = float(capacidad)
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+        # Métricas
+        self.en_espera = 0
+        self.max_en_espera = 0
+        self.admitidas = 0
+        self.rechazadas = 0
+        self.espera_total = 0.0
+
+    def _reponer(self, ahora):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+
+    def adquirir(self):
+        """Reserva un turno. Devuelve (admitida, segundos de espera)"""
+        with self.lock:
+            self._reponer(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                self.admitidas += 1
+                return True, 0.0
+            espera = -self.tokens / self.tasa
+            if self.en_espera >= self.cola_max or espera > self.espera_max:
+                # Devolver la reserva: esta solicitud no se admite
+                self.tokens += 1
+                self.rechazadas += 1
+                return False, espera
+            self.en_espera += 1
+            self.max_en_espera = max(self.max_en_espera, self.en_espera)
+            self.admitidas += 1
+            self.espera_total += espera
+        return True, espera
+
+    def liberar_espera(self):
+        with self.lock:
+            self.en_espera -= 1
+
+    def devolver(self, espera):
+        """Anula una reserva hecha con adquirir() que finalmente no se usa"""
+        with self.lock:
+            self.tokens = min(self.capacidad, self.tokens + 1)
+            self.admitidas -= 1
+            if espera > 0:
+                self.en_espera -= 1
+                self.espera_total -= espera
+
+    def metricas(self):
+        with self.lock:
+            self._reponer(time.monotonic())
+            return {
+                "tasa_por_segundo": self.tasa,
+                "rafaga": self.capacidad,
+                "tokens_disponibles": round(max(self.tokens, 0), 2),
+                "en_espera": self.en_espera,
+                "max_en_espera": self.max_en_espera,
+                "cola_max": self.cola_max,
+                "admitidas": self.admitidas,
+                "rechazadas": self.rechazadas,
+                "espera_promedio_ms": round(self.espera_total / self.admitidas * 1000, 2) if self.admitidas else 0.0
+            }
+
+
+BUCKETS = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket(cuit, operacion):
+    clave = (str(cuit), operacion)
+    bucket = BUCKETS.get(clave)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = BUCKETS.get(clave)
+            if bucket is None:
+                tasa, rafaga = limite(operacion, cuit)
+                bucket = BUCKETS[clave] = TokenBucket(tasa, rafaga)
+    return bucket
+
+
+def admitir(cuit, operacion):
+    """Espera turno para llamar a `operacion` de AFIP en nombre de `cuit`.
+
+    Lanza LimiteExcedido si la cola está llena o la espera supera ESPERA_MAX.
+    """
+    bucket = _bucket(cuit, operacion)
+    admitida, espera = bucket.adquirir()
+    if not admitida:
+        raise LimiteExcedido(cuit, operacion, espera)
+    if espera > 0:
+        print(f"⏳ Esperando {espera:.2f}s por límite de AFIP ({operacion}, CUIT {cuit})")
+        try:
+            time.sleep(espera)
+        finally:
+            bucket.liberar_espera()
+
+
+def admitir_todas(cuit, operaciones):
+    """Como admitir(), pero reserva turno en todas las operaciones antes de llamar a AFIP.
+
+    Si alguna está saturada, devuelve las reservas ya tomadas y lanza LimiteExcedido,
+    así una solicitud que terminaría en 429 no llega a consumir llamadas a AFIP.
+    """
+    reservas = []
+    for operacion in operaciones:
+        bucket = _bucket(cuit, operacion)
+        admitida, espera = bucket.adquirir()
+        if not admitida:
+            for reservado, espera_reservada in reservas:
+                reservado.devolver(espera_reservada)
+            raise LimiteExcedido(cuit, operacion, espera)
+        reservas.append((bucket, espera))
+
+    espera = max((e for _, e in reservas), default=0.0)
+    if espera > 0:
+        print(f"⏳ Esperando {espera:.2f}s por límite de AFIP ({', '.join(operaciones)}, CUIT {cuit})")
+        try:
+            time.sleep(espera)
+        finally:
+            for bucket, espera_reservada in reservas:
+                if espera_reservada > 0:
+                    bucket.liberar_espera()
+
+
+def metricas():
+    """Métricas de todos los buckets, agrupadas por CUIT y operación"""
+    with _buckets_lock:
+        items = list(BUCKETS.items())
+    resultado = {}
+    for (cuit, operacion), bucket in items:
+        resultado.setdefault(cuit, {})[operacion] = bucket.metricas()
+    return resultado
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# ======================================================================
+# TRAZAS (SPANS ANIDADOS POR REQUEST)
+# ======================================================================
+
+# Activar con TRACE_ENABLED=1. Formato: "json" (un span por línea) u "otlp"
+# (una traza por línea, formato OTLP/JSON compatible con el file exporter)
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "0") == "1"
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join(os.path.dirname(__file__), "trazas.jsonl"))
+TRACE_FORMAT = os.environ.get("TRACE_FORMAT", "json")
+SERVICE_NAME = "afip-microserver"
+
+_local = threading.local()
+_export_lock = threading.Lock()
+
+
+class Span:
+    """Un tramo de trabajo medido dentro de una traza"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "nombre", "atributos",
+                 "inicio_ns", "fin_ns", "error", "hijos")
+
+    def __init__(self, nombre, trace_id, parent_id, atributos):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.nombre = nombre
+        self.atributos = dict(atributos)
+        self.inicio_ns = time.time_ns()
+        self.fin_ns = None
+        self.error = None
+        self.hijos = []
+
+    def set(self, clave, valor):
+        self.atributos[clave] = valor
+
+    def duracion_ms(self):
+        if self.fin_ns is None:
+            return None
+        return (self.fin_ns - self.inicio_ns) / 1e6
+
+
+def _pila():
+    pila = getattr(_local, "pila", None)
+    if pila is None:
+        pila = _local.pila = []
+    return pila
+
+
+def iniciar_span(nombre, **atributos):
+    """Abre un span hijo del span activo (o una traza nueva si no hay ninguno)"""
+    if not TRACE_ENABLED:
+        return None
+    pila = _pila()
+    if pila:
+        padre = pila[-1]
+        s = Span(nombre, padre.trace_id, padre.span_id, atributos)
+        padre.hijos.append(s)
+    else:
+        s = Span(nombre, os.urandom(16).hex(), None, atributos)
+    pila.append(s)
+    return s
+
+
+def finalizar_span(s, error=None):
+    """Cierra el span; si es la raíz, exporta la traza completa"""
+    if s is None:
+        return
+    s.fin_ns = time.time_ns()
+    if error is not None:
+        s.error = f"{type(error).__name__}: {error}"
+    pila = _pila()
+    # Cerrar también hijos que hayan quedado abiertos por una excepción
+    while pila:
+        tope = pila.pop()
+        if tope is s:
+            break
+        if tope.fin_ns is None:
+            tope.fin_ns = s.fin_ns
+    if s.parent_id is None:
+        exportar_traza(s)
+
+
+@contextmanager
+def span(nombre, **atributos):
+    """Context manager para medir un bloque: `with span("wsfe.FECAESolicitar"):`"""
+    s = iniciar_span(nombre, **atributos)
+    try:
+        yield s
+    except BaseException as e:
+        finalizar_span(s, e)
+        raise
+    else:
+        finalizar_span(s)
+
+
+# ----------------------------------------------------------------------
+# EXPORTACIÓN
+# ----------------------------------------------------------------------
+
+def _aplanar(raiz):
+    spans = [raiz]
+    i = 0
+    while i < len(spans):
+        spans.extend(spans[i].hijos)
+        i += 1
+    return spans
+
+
+def _a_json(s):
+    return {
+        "trace_id": s.trace_id,
+        "span_id": s.span_id,
+        "parent_id": s.parent_id,
+        "nombre": s.nombre,
+        "inicio_ns": s.inicio_ns,
+        "duracion_ms": s.duracion_ms(),
+        "atributos": s.atributos,
+        "error": s.error
+    }
+
+
+def _valor_otlp(valor):
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, int):
+        return {"intValue": str(valor)}
+    if isinstance(valor, float):
+        return {"doubleValue": valor}
+    return {"stringValue": str(valor)}
+
+
+def _a_otlp(spans):
+    otlp_spans = []
+    for s in spans:
+        item = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.nombre,
+            "kind": 1,
+            "startTimeUnixNano": str(s.inicio_ns),
+            "endTimeUnixNano": str(s.fin_ns),
+            "attributes": [{"key": k, "value": _valor_otlp(v)} for k, v in s.atributos.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1}
+        }
+        if s.parent_id:
+            item["parentSpanId"] = s.parent_id
+        otlp_spans.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": otlp_spans}]
+        }]
+    }
+
+
+def exportar_traza(raiz):
+    """Escribe la traza al archivo local (JSON lines)"""
+    spans = _aplanar(raiz)
+    if TRACE_FORMAT == "otlp":
+        lineas = [json.dumps(_a_otlp(spans), separators=(',', ':'), default=str)]
+    else:
+        lineas = [json.dumps(_a_json(s), separators=(',', ':'), default=str) for s in spans]
+    try:
+        with _export_lock:
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write("\n".join(lineas) + "\n")
+    except Exception as e:
+        print(f"⚠ Error exportando traza: {str(e)}")
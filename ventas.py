@@ -0,0 +1,291 @@
+import os
+import io
+import csv
+import json
+import sqlite3
+import threading
+from afip_constantes import ALICUOTAS_IVA
+
+# ======================================================================
+# COMPROBANTES EMITIDOS Y AGREGADOS MENSUALES POR CUIT (CONTROL DE MONOTRIBUTO)
+# ======================================================================
+
+VENTAS_DB = os.environ.get("VENTAS_DB", os.path.join(os.path.dirname(__file__), "ventas.db"))
+
+# Notas de crédito A, B, C y M restan; el resto de los comprobantes suma
+TIPOS_NOTA_CREDITO = {3, 8, 13, 53}
+
+
+def columna_iva(alic_id):
+    """Columna del libro IVA para una alícuota, ej. 4 -> iva_10_5"""
+    return "iva_" + f"{ALICUOTAS_IVA[alic_id]:g}".replace(".", "_")
+
+
+COLUMNAS_IVA = tuple(columna_iva(i) for i in sorted(ALICUOTAS_IVA, key=ALICUOTAS_IVA.get))
+
+# Columnas de importes discriminados (se agregan a tablas creadas antes de existir)
+COLUMNAS_IMPORTES = ("importe_neto", "importe_no_gravado", "importe_exento",
+                     "importe_iva", "importe_tributos") + COLUMNAS_IVA
+
+_schema_lock = threading.Lock()
+_schema_ok = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agregados_mensuales (
+    cuit TEXT NOT NULL,
+    periodo INTEGER NOT NULL,          -- AAAAMM
+    facturado REAL NOT NULL DEFAULT 0,
+    notas_credito REAL NOT NULL DEFAULT 0,
+    cantidad INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (cuit, periodo)
+);
+
+CREATE TABLE IF NOT EXISTS comprobantes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cuit TEXT NOT NULL,
+    tipo_cbte INTEGER NOT NULL,
+    punto_venta INTEGER NOT NULL,
+    cbte_nro INTEGER NOT NULL,
+    fecha INTEGER NOT NULL,            -- AAAAMMDD
+    doc_tipo INTEGER,
+    doc_nro TEXT,
+    receptor TEXT,
+    condicion_iva_receptor INTEGER,
+    importe REAL NOT NULL,
+    moneda TEXT NOT NULL DEFAULT 'PES',
+    cotizacion REAL NOT NULL DEFAULT 1,
+    cae TEXT,
+    vencimiento_cae TEXT,
+    UNIQUE (cuit, tipo_cbte, punto_venta, cbte_nro)
+);
+CREATE INDEX IF NOT EXISTS idx_comprobantes_cuit_id ON comprobantes (cuit, id);
+"""
+
+# Columnas exportadas (orden del libro IVA ventas)
+COLUMNAS_EXPORT = (("fecha", "tipo_cbte", "punto_venta", "cbte_nro", "doc_tipo", "doc_nro",
+                    "receptor", "condicion_iva_receptor")
+                   + COLUMNAS_IMPORTES
+                   + ("importe", "moneda", "cotizacion", "cae", "vencimiento_cae", "cuit"))
+
+
+def _migrar(conn):
+    """Agrega a `comprobantes` las columnas de importes que falten"""
+    existentes = {fila[1] for fila in conn.execute("PRAGMA table_info(comprobantes)")}
+    for columna in COLUMNAS_IMPORTES:
+        if columna not in existentes:
+            conn.execute(f"ALTER TABLE comprobantes ADD COLUMN {columna} REAL")
+
+
+def columnas_importes(importes):
+    """Convierte el desglose de calcular_importes (main.py) en columnas del libro IVA"""
+    fila = {
+        "importe_neto": importes["neto"],
+        "importe_no_gravado": importes["no_gravado"],
+        "importe_exento": importes["exento"],
+        "importe_iva": importes["imp_iva"],
+        "importe_tributos": importes["imp_trib"]
+    }
+    for columna in COLUMNAS_IVA:
+        fila[columna] = 0.0
+    for alic in importes["iva"]:
+        fila[columna_iva(alic["id"])] = round(fila[columna_iva(alic["id"])] + alic["importe"], 2)
+    return fila
+
+
+def conectar():
+    """Conexión nueva por llamada (sqlite no comparte conexiones entre hilos)"""
+    global _schema_ok
+    conn = sqlite3.connect(VENTAS_DB, timeout=10)
+    if not _schema_ok:
+        with _schema_lock:
+            if not _schema_ok:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+                _migrar(conn)
+                conn.commit()
+                _schema_ok = True
+    return conn
+
+
+def periodo_de(fecha):
+    """Convierte una fecha AAAAMMDD (int o str) al período AAAAMM"""
+    return int(str(fecha)[:6])
+
+
+def sumar_periodos(periodo, meses):
+    anio, mes = divmod(periodo, 100)
+    total = anio * 12 + (mes - 1) + meses
+    return (total // 12) * 100 + (total % 12) + 1
+
+
+def _upsert(conn, cuit, periodo, tipo_cbte, importe):
+    es_nc = int(tipo_cbte) in TIPOS_NOTA_CREDITO
+    conn.execute(
+        """INSERT INTO agregados_mensuales (cuit, periodo, facturado, notas_credito, cantidad)
+           VALUES (?, ?, ?, ?, 1)
+           ON CONFLICT(cuit, periodo) DO UPDATE SET
+               facturado = facturado + excluded.facturado,
+               notas_credito = notas_credito + excluded.notas_credito,
+               cantidad = cantidad + 1""",
+        (str(cuit), periodo, 0.0 if es_nc else importe, importe if es_nc else 0.0)
+    )
+
+
+def _insertar(conn, comprobante):
+    """Inserta el comprobante si no existe. Devuelve (insertado, importe en pesos)"""
+    fila = dict(comprobante)
+    fila.setdefault("moneda", "PES")
+    fila.setdefault("cotizacion", 1.0)
+    columnas = [c for c in COLUMNAS_EXPORT if c in fila]
+    cursor = conn.execute(
+        f"INSERT OR IGNORE INTO comprobantes ({', '.join(columnas)}) "
+        f"VALUES ({', '.join('?' for _ in columnas)})",
+        [fila[c] for c in columnas]
+    )
+    return cursor.rowcount > 0, float(fila["importe"]) * float(fila["cotizacion"])
+
+
+def registrar_comprobante(comprobante):
+    """Guarda un comprobante autorizado y lo suma al agregado de su mes.
+
+    comprobante: dict con las columnas de la tabla `comprobantes`. Si ya estaba
+    registrado (mismo CUIT, tipo, punto de venta y número) no se vuelve a sumar.
+    """
+    conn = conectar()
+    try:
+        with conn:
+            insertado, importe_pesos = _insertar(conn, comprobante)
+            if insertado:
+                _upsert(conn, comprobante["cuit"], periodo_de(comprobante["fecha"]),
+                        comprobante["tipo_cbte"], importe_pesos)
+    finally:
+        conn.close()
+
+
+def reemplazar_periodos(cuit, desde, hasta, comprobantes):
+    """Recalcula los agregados de `cuit` entre `desde` y `hasta` (AAAAMM, inclusive).
+
+    comprobantes: iterable de dicts con las columnas de `comprobantes` (ver
+    consultar_comprobantes en main.py). Los que falten en la tabla se agregan y
+    después los agregados se recalculan desde la tabla completa, así no se pierden
+    los comprobantes de otros puntos de venta o tipos que no se consultaron.
+    """
+    nc = ", ".join(str(t) for t in sorted(TIPOS_NOTA_CREDITO))
+    conn = conectar()
+    try:
+        with conn:
+            for comprobante in comprobantes:
+                _insertar(conn, comprobante)
+            conn.execute("DELETE FROM agregados_mensuales WHERE cuit = ? AND periodo BETWEEN ? AND ?",
+                         (str(cuit), desde, hasta))
+            conn.execute(
+                f"""INSERT INTO agregados_mensuales (cuit, periodo, facturado, notas_credito, cantidad)
+                    SELECT cuit, fecha / 100,
+                           SUM(CASE WHEN tipo_cbte IN ({nc}) THEN 0 ELSE importe * cotizacion END),
+                           SUM(CASE WHEN tipo_cbte IN ({nc}) THEN importe * cotizacion ELSE 0 END),
+                           COUNT(*)
+                    FROM comprobantes
+                    WHERE cuit = ? AND fecha BETWEEN ? AND ?
+                    GROUP BY fecha / 100""",
+                (str(cuit), desde * 100 + 1, hasta * 100 + 31)
+            )
+    finally:
+        conn.close()
+
+
+def resumen(cuit, hasta, meses=12):
+    """Totales de los últimos `meses` meses hasta el período `hasta` (inclusive)"""
+    desde = sumar_periodos(hasta, -(meses - 1))
+    conn = conectar()
+    try:
+        filas = conn.execute(
+            """SELECT periodo, facturado, notas_credito, cantidad FROM agregados_mensuales
+               WHERE cuit = ? AND periodo BETWEEN ? AND ? ORDER BY periodo""",
+            (str(cuit), desde, hasta)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    detalle = [{
+        "periodo": periodo,
+        "facturado": round(facturado, 2),
+        "notas_credito": round(notas_credito, 2),
+        "neto": round(facturado - notas_credito, 2),
+        "cantidad": cantidad
+    } for periodo, facturado, notas_credito, cantidad in filas]
+    return {
+        "cuit": str(cuit),
+        "desde": desde,
+        "hasta": hasta,
+        "total_facturado": round(sum(d["facturado"] for d in detalle), 2),
+        "total_notas_credito": round(sum(d["notas_credito"] for d in detalle), 2),
+        "total_neto": round(sum(d["neto"] for d in detalle), 2),
+        "meses": detalle
+    }
+
+
+# ----------------------------------------------------------------------
+# EXPORTACIÓN (STREAMING, MEMORIA CONSTANTE)
+# ----------------------------------------------------------------------
+
+def iterar_comprobantes(cuit=None, desde=None, hasta=None, tipos=None, lote=1000):
+    """Genera comprobantes (dicts) filtrados, paginando por id (keyset) de a `lote` filas.
+
+    desde/hasta: fechas AAAAMMDD inclusive. tipos: iterable de tipos de comprobante.
+    """
+    condiciones = ["id > ?"]
+    params = []
+    if cuit:
+        condiciones.append("cuit = ?")
+        params.append(str(cuit))
+    if desde:
+        condiciones.append("fecha >= ?")
+        params.append(int(desde))
+    if hasta:
+        condiciones.append("fecha <= ?")
+        params.append(int(hasta))
+    if tipos:
+        tipos = [int(t) for t in tipos]
+        condiciones.append(f"tipo_cbte IN ({', '.join('?' for _ in tipos)})")
+        params.extend(tipos)
+    sql = (f"SELECT id, {', '.join(COLUMNAS_EXPORT)} FROM comprobantes "
+           f"WHERE {' AND '.join(condiciones)} ORDER BY id LIMIT ?")
+
+    conn = conectar()
+    try:
+        ultimo_id = 0
+        while True:
+            filas = conn.execute(sql, [ultimo_id, *params, lote]).fetchall()
+            if not filas:
+                break
+            for fila in filas:
+                yield dict(zip(COLUMNAS_EXPORT, fila[1:]))
+            ultimo_id = filas[-1][0]
+    finally:
+        conn.close()
+
+
+def exportar_csv(comprobantes):
+    """Genera el CSV línea por línea (con encabezado)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNAS_EXPORT)
+    for comprobante in comprobantes:
+        writer.writerow([comprobante[c] for c in COLUMNAS_EXPORT])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def exportar_jsonl(comprobantes):
+    """Genera JSON Lines, un comprobante por línea"""
+    for comprobante in comprobantes:
+        yield json.dumps(comprobante, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+EXPORTADORES = {
+    "csv": (exportar_csv, "text/csv"),
+    "jsonl": (exportar_jsonl, "application/x-ndjson"),
+}